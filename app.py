@@ -1,5 +1,7 @@
+import httpx
 import streamlit as st
-from openai import OpenAI
+from openai import NotFoundError, OpenAI
+from openai.types.beta.assistant_stream_event import ThreadMessageDelta, ThreadRunCompleted
 import os
 
 # Resolve API key from env or Streamlit secrets, fail gracefully if missing
@@ -12,8 +14,20 @@ if not api_key:
     )
     st.stop()
 
-# Init OpenAI client
-client = OpenAI(api_key=api_key)
+# Init OpenAI client once and reuse its warm connection pool across reruns
+# and sessions, instead of paying the TLS handshake on every interaction
+@st.cache_resource
+def get_openai_client() -> OpenAI:
+    return OpenAI(
+        api_key=api_key,
+        http_client=httpx.Client(
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+            timeout=httpx.Timeout(60.0, connect=5.0),
+        ),
+    )
+
+
+client = get_openai_client()
 
 # Use the Assistant you already created (with vector store attached)
 # Prefer env/secrets if provided; fallback to hardcoded value
@@ -23,16 +37,40 @@ if not ASSISTANT_ID and "ASSISTANT_ID" in st.secrets:
 if not ASSISTANT_ID:
     ASSISTANT_ID = "asst_cluFh3dbHS6ynCg547O7e0XM"  # replace with your assistant_id
 
-# Keep one thread per user session
+# Fetch only the newest message instead of the whole thread history, and
+# memoize so Streamlit reruns of the same turn don't re-hit the API. Only an
+# assistant message counts as an answer: after a failed run the newest message
+# is the user's own prompt, which must not be cached as a reply
+@st.cache_data(ttl=60)
+def fetch_latest_answer(thread_id: str, turn: int) -> str:
+    messages = client.beta.threads.messages.list(thread_id=thread_id, limit=1, order="desc")
+    if messages.data and messages.data[0].role == "assistant":
+        return messages.data[0].content[0].text.value
+    return ""
+
+
+# Keep one thread per user, carried in the URL: a reload picks the thread id
+# back up from the query params instead of creating a fresh server-side thread
 if "thread_id" not in st.session_state:
-    thread = client.beta.threads.create()
-    st.session_state.thread_id = thread.id
+    tid = st.query_params.get("tid")
+    if tid:
+        # Validate before trusting: a stale or hand-edited id would otherwise
+        # crash every reload once it reaches messages.create
+        try:
+            client.beta.threads.retrieve(tid)
+        except NotFoundError:
+            tid = None
+    if tid:
+        st.session_state.thread_id = tid
+    else:
+        thread = client.beta.threads.create()
+        st.session_state.thread_id = thread.id
+        st.query_params["tid"] = thread.id
 
 st.title("💬 AI SQL Writer Assistant")
 st.caption("Uses OpenAI Assistants API + your vector store")
 
 # Display past messages
-print("Session state: ", st.session_state)
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
@@ -52,19 +90,34 @@ if prompt := st.chat_input("Ask me to write or debug SQL..."):
         content=prompt,
     )
 
-    # Run the assistant with retrieval (since vector store is attached)
-    run = client.beta.threads.runs.create_and_poll(
+    # Run the assistant with retrieval (since vector store is attached),
+    # streaming deltas so the reply appears as soon as the first token lands
+    stream = client.beta.threads.runs.create(
         thread_id=st.session_state.thread_id,
         assistant_id=ASSISTANT_ID,
+        stream=True,
     )
 
-    # Fetch assistant reply
-    if run.status == "completed":
-        messages = client.beta.threads.messages.list(thread_id=st.session_state.thread_id)
-        answer = messages.data[0].content[0].text.value
-    else:
-        answer = "⚠️ Something went wrong — try again."
+    assistant_reply_box = st.chat_message("assistant").empty()
+    assistant_reply = ""
+    run_completed = False
+    for event in stream:
+        if isinstance(event, ThreadMessageDelta):
+            assistant_reply += event.data.delta.content[0].text.value
+            assistant_reply_box.markdown(assistant_reply)
+        elif isinstance(event, ThreadRunCompleted):
+            run_completed = True
+
+    # Fallback: fetch the reply from the thread if the stream produced no
+    # text — but only when the run completed; a failed or expired run leaves
+    # the user's own message as the newest one in the thread
+    if not assistant_reply:
+        if run_completed:
+            assistant_reply = fetch_latest_answer(
+                st.session_state.thread_id, len(st.session_state.messages)
+            )
+        assistant_reply = assistant_reply or "⚠️ Something went wrong — try again."
+        assistant_reply_box.markdown(assistant_reply)
 
-    # Save + display assistant reply
-    st.session_state.messages.append({"role": "assistant", "content": answer})
-    st.chat_message("assistant").markdown(answer)
+    # Save assistant reply
+    st.session_state.messages.append({"role": "assistant", "content": assistant_reply})
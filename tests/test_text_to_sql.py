@@ -0,0 +1,137 @@
+import asyncio
+import importlib.util
+from pathlib import Path
+from types import SimpleNamespace
+
+import streamlit as st
+from openai.types.responses import ResponseTextDeltaEvent
+
+# The module name contains a hyphen, so load it by path.
+_spec = importlib.util.spec_from_file_location(
+    "text_to_sql", Path(__file__).resolve().parent.parent / "text-to-sql.py"
+)
+text_to_sql = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(text_to_sql)
+
+
+class StubResponses:
+    """Records the request kwargs and replays a canned event stream."""
+
+    def __init__(self, events):
+        self._events = events
+        self.last_kwargs = None
+
+    async def create(self, **kwargs):
+        self.last_kwargs = kwargs
+
+        async def stream():
+            for event in self._events:
+                yield event
+
+        return stream()
+
+
+class StubEmbeddings:
+    async def create(self, **kwargs):
+        return SimpleNamespace(
+            data=[SimpleNamespace(embedding=[1.0, 0.0]) for _ in kwargs["input"]]
+        )
+
+
+class StubClient:
+    def __init__(self, events):
+        self.responses = StubResponses(events)
+        self.embeddings = StubEmbeddings()
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+def _delta_event(text, sequence_number):
+    return ResponseTextDeltaEvent(
+        content_index=0,
+        delta=text,
+        item_id="msg_1",
+        logprobs=[],
+        output_index=0,
+        sequence_number=sequence_number,
+        type="response.output_text.delta",
+    )
+
+
+def test_call_model_without_vector_store():
+    """The tool-less path must complete without raising and return (answer, usage)."""
+    usage = SimpleNamespace(input_tokens=10, output_tokens=5, total_tokens=15)
+    events = [
+        _delta_event("SELECT 1", 0),
+        _delta_event(";", 1),
+        SimpleNamespace(type="response.completed", response=SimpleNamespace(usage=usage)),
+    ]
+    client = SimpleNamespace(responses=StubResponses(events))
+
+    answer, returned_usage = asyncio.run(
+        text_to_sql.call_model(
+            client,
+            "gpt-4o-mini",
+            [],
+            "Count subjects in emulsion_amra_data",
+            system_prompt="You write one SQL query.",
+            vector_store_ids=None,
+        )
+    )
+
+    assert answer == "SELECT 1;"
+    assert returned_usage is usage
+    assert client.responses.last_kwargs["tools"] is None
+    # No vector store means no extra file_search hint turn: system + prompt only.
+    assert len(client.responses.last_kwargs["input"]) == 2
+
+
+def test_call_model_with_vector_store_attaches_file_search():
+    events = [_delta_event("SELECT 1;", 0)]
+    client = SimpleNamespace(responses=StubResponses(events))
+
+    answer, usage = asyncio.run(
+        text_to_sql.call_model(
+            client,
+            "gpt-4o-mini",
+            [],
+            "Count subjects",
+            vector_store_ids=("vs_123",),
+        )
+    )
+
+    assert answer == "SELECT 1;"
+    assert usage is None
+    assert client.responses.last_kwargs["tools"] == [
+        {"type": "file_search", "vector_store_ids": ["vs_123"]}
+    ]
+
+
+def test_run_turn_coalesces_pending_prompts(monkeypatch):
+    """Buffered prompts go out as one joined user turn and clear on success."""
+    st.session_state.clear()
+    st.session_state.messages = []
+    st.session_state._formatted_history = []
+    st.session_state._pending = []
+    # One prompt left over from an interrupted turn plus the current one.
+    for pending_prompt in ("first question", "second question"):
+        text_to_sql.append_message("user", pending_prompt)
+        st.session_state._pending.append(pending_prompt)
+
+    client = StubClient([_delta_event("SELECT 1;", 0)])
+    monkeypatch.setattr(text_to_sql, "make_openai_client", lambda api_key: client)
+
+    answer, usage = asyncio.run(
+        text_to_sql.run_turn("sk-test", "gpt-4o-mini", "second question")
+    )
+
+    assert answer == "SELECT 1;"
+    sent = client.responses.last_kwargs["input"]
+    assert sent[-1]["content"][0]["text"] == "first question\n\n---\n\nsecond question"
+    # The pending prompts are excluded from the history slice, so the merged
+    # turn is the only message in the request.
+    assert len(sent) == 1
+    assert st.session_state._pending == []
+    assert client.closed
@@ -1,21 +1,85 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
 import os
+import threading
 from typing import List, Dict, Optional, Sequence
 
+import httpx
 import streamlit as st
-from openai import OpenAI
-
-
-def resolve_openai_api_key() -> str:
-    """Return the OpenAI API key from env or Streamlit secrets, or stop the app."""
+from openai import AsyncOpenAI, RateLimitError
+from openai.types.responses import ResponseTextDeltaEvent
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+log = logging.getLogger(__name__)
+log.setLevel(os.getenv("LOGLEVEL", "WARNING"))
+
+# Cap concurrent OpenAI calls so multi-user bursts queue locally instead of
+# tripping account rate limits; size via env to match the account's RPM tier.
+# A threading semaphore, not asyncio: each Streamlit session runs in its own
+# thread with a fresh asyncio.run loop per turn, and an asyncio.Semaphore
+# shared across loops never wakes waiters released from another loop.
+SEM = threading.Semaphore(int(os.getenv("OPENAI_MAX_CONCURRENCY", "8")))
+
+
+@contextlib.asynccontextmanager
+async def openai_slot():
+    """Hold one of the process-wide OpenAI concurrency slots.
+
+    Acquired via asyncio.to_thread so a blocked acquire parks a worker thread
+    instead of stalling the event loop.
+    """
+    await asyncio.to_thread(SEM.acquire)
+    try:
+        yield
+    finally:
+        SEM.release()
+
+
+# Session-level answer cache limits and the similarity bar for treating a
+# paraphrased prompt as a repeat of an earlier one.
+CACHE_MAX_ENTRIES = 256
+CACHE_SIMILARITY_THRESHOLD = 0.95
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Once more than SUMMARY_TRIGGER messages sit outside the running summary,
+# fold all but the newest SUMMARY_KEEP into it with a cheap model call so the
+# per-request payload stops growing with conversation length.
+SUMMARY_MODEL = "gpt-4o-mini"
+SUMMARY_TRIGGER = 12
+SUMMARY_KEEP = 6
+SUMMARY_MAX_TOKENS = 150
+
+
+@st.cache_data(ttl=None)
+def resolve_openai_api_key() -> Optional[str]:
+    """Return the OpenAI API key from env or Streamlit secrets, if configured."""
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key and "OPENAI_API_KEY" in st.secrets:
         api_key = st.secrets["OPENAI_API_KEY"]
+    return api_key
+
+
+def require_openai_api_key() -> str:
+    """Return the resolved API key, or stop the app with an error if missing."""
+    api_key = resolve_openai_api_key()
     if not api_key:
+        # Don't pin the miss: st.secrets hot-reloads, so an operator adding
+        # the key should be picked up on the next rerun, not after a restart.
+        resolve_openai_api_key.clear()
         st.error("Missing OPENAI_API_KEY. Set it in the environment or Streamlit secrets.")
         st.stop()
     return api_key
 
 
+@st.cache_data(ttl=None)
 def resolve_model_name(default: str = "gpt-4o-mini") -> str:
     """Choose the model from env/secrets or fall back to the provided default."""
     model = os.getenv("OPENAI_MODEL")
@@ -24,6 +88,7 @@ def resolve_model_name(default: str = "gpt-4o-mini") -> str:
     return model or default
 
 
+@st.cache_data(ttl=None)
 def resolve_system_prompt(default: str) -> str:
     """Load custom system prompt from env/secrets or use the provided default."""
     prompt = os.getenv("DEFAULT_SQL_SYSTEM")
@@ -32,53 +97,74 @@ def resolve_system_prompt(default: str) -> str:
     return prompt or default
 
 
-def resolve_vector_store_ids() -> List[str]:
-    """Fetch vector store IDs from env/secrets; return an empty list if none found."""
+@st.cache_data(ttl=None)
+def resolve_vector_store_ids() -> tuple[str, ...]:
+    """Fetch vector store IDs from env/secrets; return an empty tuple if none found.
+
+    Returns a tuple so the cached value hashes stably across reruns.
+    """
     raw = os.getenv("VECTOR_STORE_IDS")
     if not raw and "VECTOR_STORE_IDS" in st.secrets:
         raw = st.secrets["VECTOR_STORE_IDS"]
 
     if not raw:
-        return []
+        return ()
 
     if isinstance(raw, (list, tuple)):
         ids = [item.strip() for item in raw if isinstance(item, str) and item.strip()]
     else:
         ids = [item.strip() for item in str(raw).split(",") if item.strip()]
 
-    return ids
+    return tuple(ids)
 
 
-def format_history(messages: List[Dict[str, str]]) -> List[Dict[str, object]]:
-    """Convert chat history into the structure required by the Responses API."""
-    formatted = []
-    for message in messages:
-        role = message["role"]
-        content_type = "output_text" if role == "assistant" else "input_text"
-        formatted.append(
+def format_message(role: str, text: str) -> Dict[str, object]:
+    """Convert one chat message into the structure required by the Responses API."""
+    content_type = "output_text" if role == "assistant" else "input_text"
+    return {
+        "role": role,
+        "content": [
             {
-                "role": role,
-                "content": [
-                    {
-                        "type": content_type,
-                        "text": message["content"],
-                    }
-                ],
+                "type": content_type,
+                "text": text,
             }
-        )
-    return formatted
+        ],
+    }
+
 
+def append_message(role: str, content: str) -> None:
+    """Append to the display history and the pre-formatted API history together.
 
-def call_model(
-    client: OpenAI,
+    Keeping the formatted list in session state means each turn appends one
+    dict instead of re-walking and re-building the whole history.
+    """
+    st.session_state.messages.append({"role": role, "content": content})
+    st.session_state._formatted_history.append(format_message(role, content))
+
+
+def make_openai_client(api_key: str) -> AsyncOpenAI:
+    """Build an async OpenAI client with a tuned HTTP connection pool.
+
+    Deliberately not an st.cache_resource singleton: each asyncio.run call
+    starts a fresh event loop, and httpx.AsyncClient connections are bound to
+    the loop they were opened on, so a cached client would break on reuse.
+    """
+    return AsyncOpenAI(
+        api_key=api_key,
+        http_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=100)),
+    )
+
+
+async def call_model(
+    client: AsyncOpenAI,
     model: str,
-    history: List[Dict[str, str]],
+    history: List[Dict[str, object]],
     prompt: str,
     system_prompt: Optional[str] = None,
     max_output_tokens: Optional[int] = 200,
     vector_store_ids: Optional[Sequence[str]] = None,
-) -> tuple[str, Optional[object], bool]:
-    """Call the Responses API with prior history plus the latest prompt."""
+) -> tuple[str, Optional[object]]:
+    """Stream a Responses API call with pre-formatted history plus the latest prompt."""
     conversation = []
     if system_prompt:
         conversation.append(
@@ -93,7 +179,7 @@ def call_model(
             }
         )
 
-    conversation.extend(format_history(history))
+    conversation.extend(history)
     conversation.append(
         {
             "role": "user",
@@ -106,39 +192,242 @@ def call_model(
         }
     )
 
-    tool_resources = {}
+    tools = None
     if vector_store_ids:
-        conversation.append({
-        "role": "user",
-        "content": [{"type":"input_text",
-                     "text":"If needed, briefly use file_search to confirm column names/units, then write one SQL."}]
-    })
-        tools=[{"type": "file_search", "vector_store_ids": list(vector_store_ids)}]
-    
-    print("Tools: ", tools)
+        conversation.append(
+            format_message(
+                "user",
+                "If needed, briefly use file_search to confirm column names/units, then write one SQL.",
+            )
+        )
+        tools = [{"type": "file_search", "vector_store_ids": list(vector_store_ids)}]
 
     response_kwargs = {
         "model": model,
         "input": conversation,
         "max_output_tokens": max_output_tokens,
-        "tools": tools or None,
+        "tools": tools,
+        "stream": True,
     }
 
+    # Render deltas as they arrive so perceived latency is time-to-first-token
+    # rather than the full generation time.
+    assistant_reply_box = st.empty()
+    answer = ""
+    usage = None
+    async with openai_slot():
+        # Retry only rate-limit rejections, with randomized exponential backoff.
+        async for attempt in AsyncRetrying(
+            wait=wait_random_exponential(multiplier=1, max=30),
+            stop=stop_after_attempt(6),
+            retry=retry_if_exception_type(RateLimitError),
+            reraise=True,
+        ):
+            with attempt:
+                stream = await client.responses.create(**response_kwargs)
+        async for event in stream:
+            if isinstance(event, ResponseTextDeltaEvent):
+                answer += event.delta
+                assistant_reply_box.markdown(answer)
+            elif event.type == "response.completed":
+                usage = getattr(event.response, "usage", None)
+    return answer, usage
+
 
-    response = client.responses.create(**response_kwargs)
-    print("Response: ", response)
-    answer = getattr(response, "output_text", "")
-    usage = getattr(response, "usage", None)
+async def embed_texts(client: AsyncOpenAI, texts: Sequence[str]) -> List[List[float]]:
+    """Embed a batch of texts in one API call; vectors align with the input order.
+
+    Callers that need several embeddings should pass them together rather
+    than looping — one round trip regardless of batch size.
+    """
+    async with openai_slot():
+        response = await client.embeddings.create(model=EMBEDDING_MODEL, input=list(texts))
+    return [item.embedding for item in response.data]
+
+
+async def summarize_history(
+    client: AsyncOpenAI,
+    messages: List[Dict[str, str]],
+    previous_summary: str,
+) -> str:
+    """Compress older chat turns (plus any prior summary) into a short note."""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    if previous_summary:
+        transcript = f"Existing summary: {previous_summary}\n\n{transcript}"
+
+    async with openai_slot():
+        response = await client.responses.create(
+            model=SUMMARY_MODEL,
+            input=[
+                format_message(
+                    "system",
+                    "Summarize this SQL-assistant conversation in a few sentences. "
+                    "Keep table/column names, filters, and stated user preferences.",
+                ),
+                format_message("user", transcript),
+            ],
+            max_output_tokens=SUMMARY_MAX_TOKENS,
+        )
+    return getattr(response, "output_text", "") or previous_summary
+
+
+async def maybe_summarize(client: AsyncOpenAI, reserved: int = 0) -> None:
+    """Fold messages older than the verbatim window into the running summary.
+
+    ``reserved`` trailing messages (the turn's pending prompts) are excluded,
+    so the summary boundary lines up with the verbatim slice in run_turn.
+    """
+    upto = st.session_state.get("_summarized_upto", 0)
+    eligible = len(st.session_state.messages) - reserved
+    if eligible - upto <= SUMMARY_TRIGGER:
+        return
+    cutoff = eligible - SUMMARY_KEEP
+    older = st.session_state.messages[upto:cutoff]
+    st.session_state.summary = await summarize_history(
+        client, older, st.session_state.get("summary", "")
+    )
+    st.session_state._summarized_upto = cutoff
+
+
+def _context_key(model: str, history: List[Dict[str, object]], system_prompt: Optional[str]) -> str:
+    """Hash everything except the prompt itself, so cached answers only match
+    when the surrounding conversation is identical."""
+    payload = json.dumps([model, history, system_prompt], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _evict_oldest(entries: Dict[str, object]) -> None:
+    """Drop insertion-order-oldest entries once the cache is full."""
+    while len(entries) > CACHE_MAX_ENTRIES:
+        entries.pop(next(iter(entries)))
+
+
+async def call_model_cached(
+    client: AsyncOpenAI,
+    model: str,
+    history: List[Dict[str, object]],
+    prompt: str,
+    system_prompt: Optional[str] = None,
+    max_output_tokens: Optional[int] = 200,
+    vector_store_ids: Optional[Sequence[str]] = None,
+) -> tuple[str, Optional[object]]:
+    """Serve repeated prompts from a session cache before calling the model.
+
+    Two levels: an exact hash over (model, history, system prompt, prompt),
+    then embedding similarity over the prompt alone within the same context.
+    Bypassed entirely when vector stores are attached, since file_search
+    results can change between calls.
+    """
+    if vector_store_ids:
+        return await call_model(
+            client,
+            model,
+            history,
+            prompt,
+            system_prompt=system_prompt,
+            max_output_tokens=max_output_tokens,
+            vector_store_ids=vector_store_ids,
+        )
+
+    cache = st.session_state.setdefault("_llm_cache", {"exact": {}, "vectors": []})
+    context_key = _context_key(model, history, system_prompt)
+    exact_key = hashlib.sha256(f"{context_key}:{prompt}".encode("utf-8")).hexdigest()
+
+    cached = cache["exact"].get(exact_key)
+    if cached is not None:
+        st.empty().markdown(cached)
+        return cached, None
+
+    # Semantic layer: one cheap embedding call versus a full generation.
+    (vector,) = await embed_texts(client, [prompt])
+    for entry_context, entry_vector, entry_answer in cache["vectors"]:
+        if entry_context != context_key:
+            continue
+        # OpenAI embeddings are unit-normalized, so dot product is cosine.
+        similarity = sum(a * b for a, b in zip(vector, entry_vector))
+        if similarity >= CACHE_SIMILARITY_THRESHOLD:
+            st.empty().markdown(entry_answer)
+            return entry_answer, None
+
+    answer, usage = await call_model(
+        client,
+        model,
+        history,
+        prompt,
+        system_prompt=system_prompt,
+        max_output_tokens=max_output_tokens,
+        vector_store_ids=vector_store_ids,
+    )
+
+    if answer:
+        cache["exact"][exact_key] = answer
+        _evict_oldest(cache["exact"])
+        cache["vectors"].append((context_key, vector, answer))
+        if len(cache["vectors"]) > CACHE_MAX_ENTRIES:
+            cache["vectors"].pop(0)
     return answer, usage
 
 
+async def run_turn(
+    api_key: str,
+    model: str,
+    prompt: str,
+    system_prompt: Optional[str] = None,
+    vector_store_ids: Optional[Sequence[str]] = None,
+    context_window: int = 6,
+) -> tuple[str, Optional[object]]:
+    """Answer one chat turn: summarize overflow history, then stream the reply.
+
+    Only the newest ``context_window`` messages go to the model verbatim;
+    anything older is represented by the running summary appended to the
+    system prompt. Prompts queued in ``_pending`` — including ones left over
+    from a turn that a rapid resubmission interrupted — are flushed together
+    as a single user turn; the buffer is only cleared once the call succeeds,
+    so an interrupted turn's prompt is folded into the next one.
+
+    Owns the client for the turn: the connection pool is opened and closed
+    inside the event loop that asyncio.run creates for this call.
+    """
+    pending = list(st.session_state.get("_pending") or [prompt])
+    if len(pending) > 1:
+        prompt = "\n\n---\n\n".join(pending)
+
+    client = make_openai_client(api_key)
+    try:
+        await maybe_summarize(client, reserved=len(pending))
+        summary = st.session_state.get("summary", "")
+        if summary:
+            summary_note = f"Summary of earlier conversation:\n{summary}"
+            system_prompt = f"{system_prompt}\n\n{summary_note}" if system_prompt else summary_note
+
+        # Verbatim slice starts at the summary boundary, so no message is
+        # both summarized and sent in full.
+        end = len(st.session_state._formatted_history) - len(pending)
+        start = max(end - context_window, st.session_state.get("_summarized_upto", 0))
+        prior_messages = st.session_state._formatted_history[start:end]
+        result = await call_model_cached(
+            client,
+            model,
+            prior_messages,
+            prompt,
+            system_prompt=system_prompt,
+            max_output_tokens=300,
+            vector_store_ids=vector_store_ids,
+        )
+        st.session_state._pending = []
+        return result
+    finally:
+        # Close before the loop is torn down; afterwards the pooled
+        # transports can no longer be shut cleanly.
+        await client.close()
+
+
 def main() -> None:
-    api_key = resolve_openai_api_key()
+    api_key = require_openai_api_key()
     model_name = resolve_model_name()
     system_prompt = resolve_system_prompt("")
     vector_store_ids = resolve_vector_store_ids()
-    print("Vector store IDs: ", vector_store_ids)
-    client = OpenAI(api_key=api_key)
+    log.debug("vector store ids=%s", vector_store_ids)
 
     st.title("💬 AI SQL Writer - Responses API")
     st.caption(f"Model: {model_name}")
@@ -151,38 +440,48 @@ def main() -> None:
         st.session_state.run_count = 0
     st.session_state.run_count += 1
 
-    print(f"Run #{st.session_state.run_count}")
-    print("Session state before:", dict(st.session_state))
     if "messages" not in st.session_state:
         st.session_state.messages = []
+        st.session_state._formatted_history = []
+        st.session_state._pending = []
+
+    # Log shape only; serializing message bodies would copy the whole history
+    # on every rerun.
+    log.debug(
+        "run=%d session keys=%s messages=%d",
+        st.session_state.run_count,
+        list(st.session_state.keys()),
+        len(st.session_state.messages),
+    )
 
-    print("Session state after init:", dict(st.session_state))
-
+    # No st.rerun() needed: the button click already triggered this rerun, and
+    # the history loop below renders the now-empty list.
     if st.sidebar.button("🔁 Reset conversation"):
         st.session_state.messages = []
-        st.rerun()
+        st.session_state._formatted_history = []
+        st.session_state._pending = []
+        st.session_state.summary = ""
+        st.session_state._summarized_upto = 0
 
     for msg in st.session_state.messages:
         st.chat_message(msg["role"]).markdown(msg["content"])
 
     if prompt := st.chat_input("Ask me to write or debug SQL..."):
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        append_message("user", prompt)
+        st.session_state._pending.append(prompt)
         st.chat_message("user").markdown(prompt)
 
         try:
-            #### to slice only for 6 newest messages to send to the model for saving tokens
-            context_window = 6
-            prior_messages = st.session_state.messages[:-1][-context_window:]
-            
-            answer, usage = call_model(
-                client,
-                model_name,
-                prior_messages,
-                prompt,
-                system_prompt=system_prompt,
-                max_output_tokens=300,
-                vector_store_ids=vector_store_ids,
-            )
+            with st.chat_message("assistant"):
+                answer, usage = asyncio.run(
+                    run_turn(
+                        api_key,
+                        model_name,
+                        prompt,
+                        system_prompt=system_prompt,
+                        vector_store_ids=vector_store_ids,
+                    )
+                )
             if usage:
                 input_tokens = getattr(usage, "input_text_tokens", None) or getattr(usage, "input_tokens", None)
                 output_tokens = getattr(usage, "output_text_tokens", None) or getattr(usage, "output_tokens", None)
@@ -197,12 +496,16 @@ def main() -> None:
 
         except Exception as exc:  # noqa: BLE001 - surface any OpenAI/HTTP error cleanly
             answer = f"⚠️ Error calling OpenAI: {exc}"
+            st.chat_message("assistant").markdown(answer)
+            # The error reply below answers the buffered prompts, so drop them
+            # rather than folding them into the next turn.
+            st.session_state._pending = []
 
         if not answer:
             answer = "⚠️ No response received, please try again."
+            st.chat_message("assistant").markdown(answer)
 
-        st.session_state.messages.append({"role": "assistant", "content": answer})
-        st.chat_message("assistant").markdown(answer)
+        append_message("assistant", answer)
 
 
 if __name__ == "__main__":